@@ -1,40 +1,66 @@
 import os
 import sys
-import time
+import hashlib
+import mimetypes
+import threading
 from flask import Flask, render_template, request, jsonify
 from werkzeug.utils import secure_filename
 
 # Add src to path for c2pa_checker import
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'src'))
 
-from c2pa_checker import check_c2pa
-from combine_model import AIEnsemblePredictor
+from c2pa_checker import check_c2pa_bytes
 from forensic import generate_forensic_report
 
+# Try to import orjson - faster JSON encoding, falls back to jsonify when missing
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
 # -------- CONFIG --------
-UPLOAD_FOLDER = 'uploads'
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'webp'}
+_ALLOWED_SUFFIXES = tuple('.' + ext for ext in ALLOWED_EXTENSIONS)
 
 app = Flask(__name__, template_folder='templates', static_folder='static')
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max
 
-# Create uploads folder if it doesn't exist
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-
-# Load AI model once at startup
-print("🚀 Initializing AI Detection Models...")
+# AI models are loaded on the first request that needs them, so startup (and
+# C2PA-verified requests) never pay the torch/transformers import cost
 predictor = None
-try:
-    predictor = AIEnsemblePredictor()
-    print("✅ Models loaded successfully!")
-except Exception as e:
-    print(f"⚠️ Warning: Could not load AI models: {e}")
-    print("   C2PA checking will still work, but AI detection will be unavailable.")
+_predictor_load_attempted = False
+_predictor_load_failed = False
+_predictor_lock = threading.Lock()
+
+
+def get_predictor():
+    global predictor, _predictor_load_attempted, _predictor_load_failed
+    with _predictor_lock:
+        if not _predictor_load_attempted:
+            _predictor_load_attempted = True
+            print("🚀 Initializing AI Detection Models...")
+            try:
+                from combine_model import AIEnsemblePredictor
+                predictor = AIEnsemblePredictor()
+                print("✅ Models loaded successfully!")
+            except Exception as e:
+                _predictor_load_failed = True  # Details go to the log only, not /healthz
+                print(f"⚠️ Warning: Could not load AI models: {e}")
+                print("   C2PA checking will still work, but AI detection will be unavailable.")
+    return predictor
 
 
 def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+    return filename.lower().endswith(_ALLOWED_SUFFIXES)
+
+
+def json_response(data):
+    if ORJSON_AVAILABLE:
+        # OPT_SERIALIZE_NUMPY covers the numpy floats returned by the predictor
+        body = orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY)
+        return app.response_class(body, mimetype='application/json')
+    return jsonify(data)
 
 
 # -------- ROUTES --------
@@ -53,6 +79,16 @@ def report():
     return render_template('report.html')
 
 
+@app.route('/healthz')
+def healthz():
+    return jsonify({
+        'status': 'ok',
+        'models_loaded': predictor is not None,
+        'models_load_attempted': _predictor_load_attempted,
+        'models_load_failed': _predictor_load_failed
+    })
+
+
 @app.route('/api/analyze', methods=['POST'])
 def analyze_image():
     """
@@ -69,10 +105,13 @@ def analyze_image():
     if not allowed_file(file.filename):
         return jsonify({'success': False, 'error': 'File type not allowed'}), 400
 
-    # Save uploaded file
+    # Keep the upload in memory (bounded by MAX_CONTENT_LENGTH) instead of saving it to disk
     filename = secure_filename(file.filename)
-    filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-    file.save(filepath)
+    raw_bytes = file.read()
+    # Guess from the original name: allowed_file checked its suffix, while secure_filename may strip it (e.g. non-ASCII names)
+    mime_type = mimetypes.guess_type(file.filename)[0] or file.mimetype
+    # Hashed once here; keys both the C2PA and the prediction caches
+    content_hash = hashlib.blake2b(raw_bytes, digest_size=16).hexdigest()
 
     result = {
         'success': True,
@@ -89,8 +128,7 @@ def analyze_image():
 
     try:
         # ========== LAYER 1: C2PA CHECK ==========
-        time.sleep(1.5)  # Simulated processing time
-        c2pa_result = check_c2pa(filepath)
+        c2pa_result = check_c2pa_bytes(raw_bytes, mime_type, content_hash)
         result['layers']['c2pa'] = c2pa_result
 
         # Check if C2PA library is available on this platform
@@ -105,22 +143,19 @@ def analyze_image():
             result['layers']['c2pa']['status'] = 'verified'
             
             # Skip other layers since we have cryptographic proof
-            time.sleep(0.5)
             result['layers']['synthid'] = {'status': 'skipped', 'reason': 'C2PA verification successful'}
-            time.sleep(0.5)
             result['layers']['ai_model'] = {'status': 'skipped', 'reason': 'C2PA verification successful'}
             
         else:
             # ========== LAYER 2: SYNTHID (SKIPPED) ==========
-            time.sleep(1.0)  # Simulated processing time
             result['layers']['synthid'] = {'status': 'skipped', 'reason': 'Not implemented'}
             
             # ========== LAYER 3: AI MODEL ==========
-            time.sleep(2.0)  # Simulated model loading/inference time
-            print(f"[DEBUG] predictor is None: {predictor is None}")
-            if predictor is not None:
-                print(f"[DEBUG] Calling predictor.predict({filepath})")
-                label, confidence = predictor.predict(filepath)
+            model = get_predictor()
+            print(f"[DEBUG] predictor is None: {model is None}")
+            if model is not None:
+                print(f"[DEBUG] Calling predictor.predict_from_bytes({filename}, {len(raw_bytes)} bytes)")
+                label, confidence = model.predict_from_bytes(raw_bytes, content_hash)
                 print(f"[DEBUG] Result: label={label}, confidence={confidence}")
                 confidence_percent = confidence * 100
                 
@@ -143,13 +178,8 @@ def analyze_image():
     except Exception as e:
         result['success'] = False
         result['error'] = str(e)
-    
-    finally:
-        # Clean up uploaded file
-        if os.path.exists(filepath):
-            os.remove(filepath)
 
-    return jsonify(result)
+    return json_response(result)
 
 
 @app.route('/api/forensic-report', methods=['POST'])
@@ -171,6 +201,7 @@ def get_forensic_report():
 
 
 # -------- RUN --------
+# Production: gunicorn app:app (settings in gunicorn.conf.py)
 if __name__ == '__main__':
     import os
     port = int(os.environ.get("PORT", 7860))
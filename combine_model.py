@@ -1,11 +1,33 @@
 import os
+import io
+import sys
+import copy
+import gc
+import hashlib
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 import torch
 import torch.nn as nn
 from torchvision import models, transforms
-from transformers import AutoImageProcessor, AutoModelForImageClassification
 from PIL import Image
 import numpy as np
-import joblib
+
+# Try to import torch_tensorrt - registers the "tensorrt" torch.compile backend (NVIDIA GPUs only)
+try:
+    import torch_tensorrt  # noqa: F401
+    TENSORRT_AVAILABLE = True
+except ImportError:
+    TENSORRT_AVAILABLE = False
+
+# Try to import onnxruntime - used instead of PyTorch for CPU-only deployments
+try:
+    import onnxruntime as ort
+    ONNXRUNTIME_AVAILABLE = True
+except ImportError:
+    ONNXRUNTIME_AVAILABLE = False
 
 # -------- CONFIG --------
 RESNET_PATH = "model_output/resnet50_finetuned_benchmark.pth"
@@ -13,11 +35,30 @@ VIT_NAME = "dima806/ai_vs_real_image_detection"
 META_LEARNER_PATH = "ai_detector_meta_learner.joblib"  # Created by your previous script
 POLY_TRANSFORM_PATH = "polynomial_transformer.joblib"  # Created by your previous script
 DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+# Inputs are 224x224 and the batcher only ever sends 1..MAX_BATCH images, so there are few enough
+# input shapes for cuDNN to benchmark each once (during _warmup) and cache the fastest conv algorithms
+torch.backends.cudnn.benchmark = True
+PREDICTION_CACHE_SIZE = 1024  # Max (label, confidence) results kept in memory
+USE_FP16 = True  # Run ResNet + ViT in half precision on CUDA (meta-learner stays FP32)
+COMPILE_MODELS = True  # torch.compile ResNet + ViT (TensorRT on CUDA, Inductor otherwise)
+MAX_BATCH = 16  # Max concurrent images stacked into one forward pass
+BATCH_WAIT_MS = 10  # How long the batcher waits for more images before running
+PREPROCESS_WORKERS = 4  # Threads used to resize the images of a batch
+USE_ONNX_ON_CPU = True  # Run ResNet + ViT through ONNX Runtime when no GPU is available
+RESNET_ONNX_PATH = "model_output/resnet50.onnx"  # Exported from RESNET_PATH on first CPU start
+VIT_ONNX_PATH = "model_output/vit.onnx"  # Exported from VIT_NAME on first CPU start
+VIT_ONNX_SOURCE_PATH = VIT_ONNX_PATH + ".source"  # Checkpoint the ViT export was made from
 
 class AIEnsemblePredictor:
-    def __init__(self):
+    def __init__(self, export_only=False):
+        """export_only=True just loads the weights (for --export-onnx): no backend setup, warm-up or batcher."""
+        # Deferred so importing this module stays cheap until the predictor is actually built
+        from transformers import AutoImageProcessor, AutoModelForImageClassification
+        import joblib
+
         print(f"⏳ Loading models to {DEVICE}...")
         self.device = DEVICE
+        self.dtype = torch.float16 if USE_FP16 and DEVICE.type == "cuda" else torch.float32
         
         # 1. Load ResNet50
         self.resnet = models.resnet50(weights=None)
@@ -29,75 +70,324 @@ class AIEnsemblePredictor:
         else:
             raise FileNotFoundError(f"Could not find ResNet model at {RESNET_PATH}")
             
-        self.resnet.to(self.device).eval()
+        self.resnet.to(self.device, self.dtype).eval()
         
-        # ResNet Preprocessing
-        self.res_transform = transforms.Compose([
-            transforms.Resize((224, 224)),
-            transforms.ToTensor(),
-            transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+        # Shared Preprocessing: one decode + resize feeds both models, each normalized on device
+        self.transform = transforms.Compose([
+            transforms.Resize((224, 224), interpolation=transforms.InterpolationMode.BILINEAR),
+            transforms.PILToTensor()
         ])
+        self.res_mean, self.res_std = self._norm_stats([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
 
         # 2. Load ViT
-        self.vit = AutoModelForImageClassification.from_pretrained(VIT_NAME).to(self.device).eval()
+        self.vit = AutoModelForImageClassification.from_pretrained(VIT_NAME).to(self.device, self.dtype).eval()
         self.vit_processor = AutoImageProcessor.from_pretrained(VIT_NAME)
+        self._check_vit_preprocessing()
+        # Same bilinear 224x224 resize as ResNet, only the mean/std differ
+        self.vit_mean, self.vit_std = self._norm_stats(self.vit_processor.image_mean, self.vit_processor.image_std)
         print("✅ ViT loaded.")
 
         # 3. Load Meta-Learner (Polynomial + Logistic Regression)
         if os.path.exists(META_LEARNER_PATH) and os.path.exists(POLY_TRANSFORM_PATH):
-            self.meta_model = joblib.load(META_LEARNER_PATH)
-            self.poly = joblib.load(POLY_TRANSFORM_PATH)
+            meta_model = joblib.load(META_LEARNER_PATH)
+            poly = joblib.load(POLY_TRANSFORM_PATH)
+            # Fold the pair into sigmoid(intercept + sum(coef_i * r^a_i * v^b_i)) so sklearn stays off the hot path
+            self.meta_powers = poly.powers_.astype(np.float64)  # (n_terms, 2) exponents of [r, v]
+            self.meta_coef = meta_model.coef_[0].astype(np.float64)
+            self.meta_intercept = float(meta_model.intercept_[0])
             print("✅ Meta-Learner loaded.")
         else:
             raise FileNotFoundError("Meta-learner files not found! Run the training script first to generate .joblib files.")
 
+        if export_only:
+            return
+
+        # Independent branches of the ensemble get their own CUDA streams so their kernels can overlap
+        if self.device.type == "cuda":
+            self.s_res = torch.cuda.Stream()
+            self.s_vit = torch.cuda.Stream()
+        else:
+            self.s_res = self.s_vit = None
+
+        # 4. Pick the inference backend (ONNX Runtime on CPU, compiled PyTorch otherwise), then warm up
+        self.ort_resnet = self.ort_vit = None
+        if self.device.type == "cpu" and USE_ONNX_ON_CPU and ONNXRUNTIME_AVAILABLE:
+            self._load_onnx()
+        elif COMPILE_MODELS:
+            self._compile_models()
+        else:
+            self._warmup()
+
+        # 5. Prediction cache (content hash -> (label, confidence)), LRU order
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+
+        # 6. Preprocessing pool + micro-batcher: concurrent predict() calls share one forward pass
+        self._preprocess_pool = ThreadPoolExecutor(max_workers=PREPROCESS_WORKERS)
+        self._batcher = _MicroBatcher(self.predict_batch, MAX_BATCH, BATCH_WAIT_MS / 1000)
+
+    def _compile_models(self):
+        backend = "tensorrt" if self.device.type == "cuda" and TENSORRT_AVAILABLE else "inductor"
+        eager_resnet, eager_vit = self.resnet, self.vit
+        try:
+            self.resnet = torch.compile(eager_resnet, backend=backend)
+            self.vit = torch.compile(eager_vit, backend=backend)
+
+            # First call triggers compilation, so pay it here rather than on a request
+            self._warmup(sweep=True)
+            print(f"✅ Models compiled ({backend}).")
+        except Exception as e:
+            self.resnet, self.vit = eager_resnet, eager_vit
+            print(f"⚠️ Warning: torch.compile failed, using eager models: {e}")
+            self._warmup()
+
+    def export_onnx(self):
+        """Export ResNet and ViT to ONNX when missing or stale. Run `python combine_model.py --export-onnx`
+        at build time on deployments whose filesystem is read-only at runtime."""
+        dummy = torch.randn(1, 3, 224, 224)
+
+        # Re-export whenever the PyTorch weights are newer than the ONNX file
+        if not os.path.exists(RESNET_ONNX_PATH) or os.path.getmtime(RESNET_ONNX_PATH) < os.path.getmtime(RESNET_PATH):
+            resnet = copy.deepcopy(getattr(self.resnet, "_orig_mod", self.resnet)).float().cpu()
+            torch.onnx.export(resnet, (dummy,), RESNET_ONNX_PATH, opset_version=17,
+                              input_names=["input"], output_names=["logits"],
+                              dynamic_axes={"input": {0: "batch"}, "logits": {0: "batch"}})
+            print(f"✅ Exported {RESNET_ONNX_PATH}")
+
+        # The sidecar records which checkpoint (name + hub revision) the ViT file came from
+        vit_source = f"{VIT_NAME}@{getattr(self.vit.config, '_commit_hash', None)}"
+        exported_source = None
+        if os.path.exists(VIT_ONNX_PATH) and os.path.exists(VIT_ONNX_SOURCE_PATH):
+            with open(VIT_ONNX_SOURCE_PATH) as f:
+                exported_source = f.read().strip()
+        if exported_source != vit_source:
+            vit = copy.deepcopy(getattr(self.vit, "_orig_mod", self.vit)).float().cpu()
+            torch.onnx.export(vit, (dummy,), VIT_ONNX_PATH, opset_version=17,
+                              input_names=["pixel_values"], output_names=["logits"],
+                              dynamic_axes={"pixel_values": {0: "batch"}, "logits": {0: "batch"}})
+            with open(VIT_ONNX_SOURCE_PATH, "w") as f:
+                f.write(vit_source)
+            print(f"✅ Exported {VIT_ONNX_PATH} ({vit_source})")
+
+    def _load_onnx(self):
+        try:
+            self.export_onnx()
+        except OSError as e:
+            print(f"⚠️ Warning: could not write ONNX models ({e}). On read-only deployments, "
+                  "run `python combine_model.py --export-onnx` at build time.")
+
+        try:
+            so = ort.SessionOptions()
+            so.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+            so.intra_op_num_threads = os.cpu_count()
+            providers = ["CPUExecutionProvider"]
+            self.ort_resnet = ort.InferenceSession(RESNET_ONNX_PATH, sess_options=so, providers=providers)
+            self.ort_vit = ort.InferenceSession(VIT_ONNX_PATH, sess_options=so, providers=providers)
+
+            self._warmup()
+            # The sessions replace the PyTorch modules on this path, so don't keep both in memory
+            self.resnet = self.vit = None
+            gc.collect()
+            print("✅ ONNX Runtime sessions loaded.")
+        except Exception as e:
+            self.ort_resnet = self.ort_vit = None
+            print(f"⚠️ Warning: ONNX Runtime setup failed, using PyTorch models: {e}")
+            self._warmup()
+
     def predict(self, image_path):
         if not os.path.exists(image_path):
             return "Error", f"Image not found at {image_path}"
 
+        with open(image_path, "rb") as f:
+            return self.predict_from_bytes(f.read())
+
+    def predict_from_bytes(self, raw, content_hash=None):
+        # Re-uploads of the same file skip inference entirely; callers may pass the
+        # blake2b (16-byte hex) digest they already computed
+        key = content_hash or hashlib.blake2b(raw, digest_size=16).hexdigest()
+        with self._cache_lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+
         # Open Image
         try:
-            img = Image.open(image_path).convert("RGB")
+            img = Image.open(io.BytesIO(raw)).convert("RGB")
         except Exception as e:
             return "Error", f"Invalid image file: {e}"
 
-        with torch.no_grad():
-            # --- ResNet Prediction ---
-            res_input = self.res_transform(img).unsqueeze(0).to(self.device)
-            res_logits = self.resnet(res_input)
-            # Get probability for Class 1 (AI)
-            res_prob = torch.softmax(res_logits, dim=1)[0, 1].item()
+        result = self._batcher.submit(img).result()
 
-            # --- ViT Prediction ---
-            vit_inputs = self.vit_processor(images=img, return_tensors="pt").to(self.device)
-            vit_logits = self.vit(**vit_inputs).logits
-            # Get probability for Class 1 (AI)
-            vit_prob = torch.softmax(vit_logits, dim=1)[0, 1].item()
+        # Only cache successful predictions
+        if result[0] != "Error":
+            with self._cache_lock:
+                self._cache[key] = result
+                if len(self._cache) > PREDICTION_CACHE_SIZE:
+                    self._cache.popitem(last=False)
+
+        return result
+
+    def _warmup(self, sweep=None):
+        # Dummy forwards so compilation and cuDNN autotuning happen before the first real request.
+        # Only those fill a per-shape cache, so only they (sweep=True for compiled models, or CUDA
+        # with cudnn.benchmark) run every batch size the batcher can produce. MAX_BATCH goes first
+        # with the batch dim marked dynamic, compiling the graph shared by sizes 2..MAX_BATCH; size 1
+        # gets its own since Dynamo always specializes size-1 dims. ORT / eager CPU get one forward.
+        if sweep is None:
+            sweep = self.device.type == "cuda" and torch.backends.cudnn.benchmark
+        pixels = self.transform(Image.new("RGB", (224, 224)))
+        with torch.inference_mode():
+            for n in (range(MAX_BATCH, 0, -1) if sweep else (1,)):
+                res_input, vit_input = self._prepare([pixels] * n)
+                if n > 1:
+                    torch._dynamo.mark_dynamic(res_input, 0)
+                    torch._dynamo.mark_dynamic(vit_input, 0)
+                self._forward(res_input, vit_input)
+
+    def _check_vit_preprocessing(self):
+        # The shared transform stands in for vit_processor, so refuse checkpoints that preprocess differently
+        p = self.vit_processor
+        size = (p.size.get("height"), p.size.get("width")) if p.do_resize else None
+        matches = (
+            size == (224, 224)
+            and int(p.resample) == int(Image.Resampling.BILINEAR)
+            and p.do_rescale and abs(p.rescale_factor - 1 / 255) < 1e-9
+            and p.do_normalize
+        )
+        if not matches:
+            raise ValueError(
+                f"{VIT_NAME} preprocessing (size={p.size}, resample={p.resample}, "
+                f"rescale={p.do_rescale}/{p.rescale_factor}, normalize={p.do_normalize}) "
+                "does not match the shared 224x224 bilinear transform"
+            )
+
+    def _norm_stats(self, mean, std):
+        shape = (1, 3, 1, 1)
+        return (torch.tensor(mean, device=self.device).view(shape),
+                torch.tensor(std, device=self.device).view(shape))
+
+    def _prepare(self, pixels):
+        """Turn a list of uint8 CHW tensors into normalized (ResNet, ViT) input batches on device."""
+        batch = torch.stack(pixels)
+        # Pinned host memory lets the H2D copy run asynchronously
+        if self.device.type == "cuda":
+            batch = batch.pin_memory()
+        batch = batch.to(self.device, non_blocking=True).float().div_(255)
+
+        res_input = ((batch - self.res_mean) / self.res_std).to(self.dtype)
+        vit_input = ((batch - self.vit_mean) / self.vit_std).to(self.dtype)
+        return res_input, vit_input
+
+    def _forward(self, res_input, vit_input):
+        """Run ResNet and ViT, concurrently on separate streams when on CUDA. Returns FP32 logits."""
+        if self.ort_resnet is not None:
+            res_logits = self.ort_resnet.run(None, {"input": res_input.numpy()})[0]
+            vit_logits = self.ort_vit.run(None, {"pixel_values": vit_input.numpy()})[0]
+            return torch.from_numpy(res_logits), torch.from_numpy(vit_logits)
+
+        if self.s_res is None:
+            return self.resnet(res_input).float(), self.vit(pixel_values=vit_input).logits.float()
+
+        # Side streams must see the inputs produced on the current stream, and vice versa for the outputs
+        current = torch.cuda.current_stream()
+        self.s_res.wait_stream(current)
+        self.s_vit.wait_stream(current)
+        with torch.cuda.stream(self.s_res):
+            res_logits = self.resnet(res_input).float()
+        with torch.cuda.stream(self.s_vit):
+            vit_logits = self.vit(pixel_values=vit_input).logits.float()
+        current.wait_stream(self.s_res)
+        current.wait_stream(self.s_vit)
+        return res_logits, vit_logits
+
+    def predict_batch(self, images):
+        """Run the ensemble on a list of RGB PIL images, returning one (label, confidence) per image."""
+        # Resize on the pool threads
+        pixels = list(self._preprocess_pool.map(self.transform, images))
+
+        with torch.inference_mode():
+            res_input, vit_input = self._prepare(pixels)
+
+            # --- ResNet + ViT Prediction ---
+            res_logits, vit_logits = self._forward(res_input, vit_input)
+
+            # Get probability for Class 1 (AI), stacked on device as [ResNet_Score, ViT_Score] per image
+            # so the whole batch comes back to the host in a single copy
+            res_probs = torch.softmax(res_logits, dim=1)[:, 1]
+            vit_probs = torch.softmax(vit_logits, dim=1)[:, 1]
+            raw_scores = torch.stack([res_probs, vit_probs], dim=1).cpu().numpy().astype(np.float64)
 
         # --- Meta-Learner Ensemble ---
-        # Stack scores: [ResNet_Score, ViT_Score]
-        raw_scores = np.array([[res_prob, vit_prob]])
         
-        # Polynomial Expansion (Degree 2)
-        poly_features = self.poly.transform(raw_scores)
+        # Polynomial Expansion (Degree 2): each term is r^a * v^b
+        poly_features = np.prod(raw_scores[:, None, :] ** self.meta_powers, axis=2)
         
-        # Final Prediction
-        # index 1 is usually the "Positive" class (AI) in sklearn if labeled that way during training
-        final_ai_prob = self.meta_model.predict_proba(poly_features)[0, 1]
+        # Final Prediction: logistic regression probability of class 1 (AI)
+        final_ai_probs = 1.0 / (1.0 + np.exp(-(poly_features @ self.meta_coef + self.meta_intercept)))
         
-        # Determine Label and confidence
-        # Confidence should reflect certainty of the prediction, not just AI probability
-        if final_ai_prob > 0.5:
-            label = "AI Image"
-            confidence = final_ai_prob  # How confident we are it's AI
-        else:
-            label = "Real Image"
-            confidence = 1 - final_ai_prob  # How confident we are it's Real
-        
-        return label, confidence
+        results = []
+        for final_ai_prob in final_ai_probs:
+            # Determine Label and confidence
+            # Confidence should reflect certainty of the prediction, not just AI probability
+            if final_ai_prob > 0.5:
+                label = "AI Image"
+                confidence = final_ai_prob  # How confident we are it's AI
+            else:
+                label = "Real Image"
+                confidence = 1 - final_ai_prob  # How confident we are it's Real
+            results.append((label, confidence))
+
+        return results
+
+
+class _MicroBatcher:
+    """Collects images from concurrent callers and runs them through predict_batch together."""
+
+    def __init__(self, predict_batch, max_batch, max_wait):
+        self.predict_batch = predict_batch
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._run, name="ai-micro-batcher", daemon=True)
+        self._worker.start()
+
+    def submit(self, img):
+        future = Future()
+        self._queue.put((img, future))
+        return future
+
+    def _run(self):
+        while True:
+            # Block for the first image, then gather more until the batch is full or the window closes
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            images = [img for img, _ in batch]
+            try:
+                results = self.predict_batch(images)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+
 
 # -------- EXECUTION --------
 if __name__ == "__main__":
+    if "--export-onnx" in sys.argv:
+        AIEnsemblePredictor(export_only=True).export_onnx()
+        sys.exit(0)
+
     # Initialize the predictor (loads models once)
     predictor = AIEnsemblePredictor()
 
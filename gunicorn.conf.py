@@ -0,0 +1,13 @@
+# Production server config: gunicorn app:app
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 7860)}"
+
+# A single worker process keeps one copy of the models in memory; its request
+# threads feed the predictor's micro-batcher so concurrent uploads share a forward pass.
+worker_class = "gthread"
+workers = 1
+threads = 16
+
+# Model loading on the first AI request can take a while
+timeout = 120
@@ -1,4 +1,10 @@
+import io
+import copy
 import json
+import hashlib
+import mimetypes
+import threading
+from collections import OrderedDict
 
 # Try to import c2pa - may not be available on all platforms (e.g., Vercel)
 try:
@@ -7,7 +13,59 @@ try:
 except ImportError:
     C2PA_AVAILABLE = False
 
+C2PA_CACHE_SIZE = 2048  # Max check results kept in memory, keyed by content hash
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
 def check_c2pa(file_path):
+    mime_type = mimetypes.guess_type(file_path)[0]
+    if mime_type is None:
+        # Unrecognised extension: let the library work out the format from the path itself
+        return _read_manifest(lambda: c2pa.Reader(file_path))
+
+    try:
+        with open(file_path, "rb") as f:
+            data = f.read()
+    except OSError as e:
+        return {"c2pa_present": False, "error": str(e)}
+    return check_c2pa_bytes(data, mime_type)
+
+
+def check_c2pa_bytes(data, mime_type, content_hash=None):
+    """Same as check_c2pa, but reads the manifest from in-memory image bytes.
+
+    content_hash lets callers that already hashed the upload (blake2b, 16-byte hex digest) skip rehashing it.
+    """
+    # The validation status covers the whole asset, so the key hashes all of it
+    if content_hash is None:
+        content_hash = hashlib.blake2b(data, digest_size=16).hexdigest()
+    key = (content_hash, mime_type)
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            # Callers annotate the result (e.g. app.py sets 'status'), so never hand out the cached dict
+            return copy.deepcopy(_cache[key])
+
+    result = _check_c2pa(data, mime_type)
+
+    # Only cache clean results - reader errors may be transient or caused by a wrong mime_type
+    if "error" not in result:
+        with _cache_lock:
+            _cache[key] = copy.deepcopy(result)
+            if len(_cache) > C2PA_CACHE_SIZE:
+                _cache.popitem(last=False)
+
+    return result
+
+
+def _check_c2pa(data, mime_type):
+    # Read the manifest store from the in-memory image bytes
+    return _read_manifest(lambda: c2pa.Reader(mime_type, io.BytesIO(data)))
+
+
+def _read_manifest(open_reader):
     if not C2PA_AVAILABLE:
         return {
             "c2pa_present": False,
@@ -16,8 +74,8 @@ def check_c2pa(file_path):
         }
     
     try:
-        # Read the manifest store from the file using Reader
-        reader = c2pa.Reader(file_path)
+        # Read the manifest store using Reader
+        reader = open_reader()
         manifest_store_json = reader.json()
 
         if not manifest_store_json:
@@ -42,23 +100,19 @@ def check_c2pa(file_path):
         signature = active_manifest.get("signature_info", {})
         issuer = signature.get("issuer")
         
-        # Look for assertions
+        # Look for an AI source type in c2pa.actions assertions (stops at the first hit)
         assertions = active_manifest.get("assertions", [])
-        is_ai = False
-        
-        for assertion in assertions:
-            if assertion.get("label") == "c2pa.actions":
-                actions = assertion.get("data", {}).get("actions", [])
-                for action in actions:
-                    if "trainedAlgorithmicMedia" in action.get("digitalSourceType", ""):
-                        is_ai = True
+        is_ai = any(
+            "trainedAlgorithmicMedia" in (action.get("digitalSourceType") or "")
+            for assertion in assertions if assertion.get("label") == "c2pa.actions"
+            for action in assertion.get("data", {}).get("actions", [])
+        )
 
         return {
             "c2pa_present": True,
             "valid": is_valid,
             "issuer": issuer,
-            "ai_generated": is_ai,
-            "raw_data": manifest_data  # Return full data if needed
+            "ai_generated": is_ai
         }
     except c2pa.C2paError as e:
         # No manifest found or other C2PA-specific error